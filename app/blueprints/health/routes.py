@@ -1,11 +1,26 @@
-﻿from datetime import datetime, timezone
+﻿import time
+from datetime import datetime, timezone
 
 from . import bp
 
+# (segundo epoch, texto): probes chegam varias vezes por segundo, entao o
+# timestamp formatado e reaproveitado dentro do mesmo segundo.
+_ts_cache = (0, "")
+
+
+def _utc_ts() -> str:
+    global _ts_cache
+    now = int(time.time())
+    cached_sec, cached_text = _ts_cache
+    if cached_sec != now:
+        cached_text = str(datetime.fromtimestamp(now, tz=timezone.utc))
+        _ts_cache = (now, cached_text)
+    return cached_text
+
 
 @bp.get("/abacaxi")
 def abacaxi():
-    return {"status": "ok", "ts": str(datetime.now(timezone.utc))}
+    return {"status": "ok", "ts": _utc_ts()}
 
 
 @bp.get("/healthz")
@@ -1,33 +1,29 @@
 ﻿from flask import current_app, request
 
-from app.extensions import get_df_client, get_fs, get_http_session, get_speech_client
-from app.repositories.firestore_repo import FirestoreRepository
-from app.services.webhook_service import (
-    get_aggregation_debug_info,
-    handle_webhook,
-    twiml_empty,
-)
+from app.extensions import get_df_client, get_fs_repo, get_http_session, get_speech_client
 
 from . import bp
 
+# webhook_service puxa os SDKs do Google (CX, Firestore, Speech -> gRPC/protobuf)
+# na importacao: ele so e carregado na primeira requisicao destas rotas, e o
+# boot do app e o /healthz ficam sem esse custo.
+
 
 @bp.post("/twiml-test")
 def twiml_test():
+    from app.services.webhook_service import twiml_empty
+
     return twiml_empty(status=200)
 
 
 @bp.post("/webhook")
 def webhook():
-    settings = current_app.config
-    repo = FirestoreRepository(
-        get_fs(),
-        settings.get("FS_CONV_COLL"),
-        settings.get("FS_MSG_SUBCOLL"),
-    )
+    from app.services.webhook_service import handle_webhook
+
     return handle_webhook(
         request,
-        settings=settings,
-        repo=repo,
+        settings=current_app.config,
+        repo=get_fs_repo(),
         cx_client=get_df_client(),
         http_session=get_http_session(),
         speech_client=get_speech_client(),
@@ -36,4 +32,6 @@ def webhook():
 
 @bp.get("/debug/buffers")
 def debug_buffers():
+    from app.services.webhook_service import get_aggregation_debug_info
+
     return get_aggregation_debug_info(current_app.config)
@@ -1,8 +1,13 @@
-﻿import os
+﻿import functools
+import os
+
+# Snapshot unico do ambiente: BaseConfig e avaliado no import, entao reler
+# os.environ a cada chave nao traz nada alem de custo.
+_ENV = dict(os.environ)
 
 
 def _bool_env(name, default="false"):
-    return os.getenv(name, default).lower() == "true"
+    return _ENV.get(name, default).lower() == "true"
 
 
 def _normalize_for_exact_match(text):
@@ -10,7 +15,7 @@ def _normalize_for_exact_match(text):
 
 
 def _handoff_hints_env(name, default=""):
-    raw = (os.getenv(name, default) or "").strip()
+    raw = (_ENV.get(name, default) or "").strip()
     if not raw:
         return []
 
@@ -30,14 +35,14 @@ def _handoff_hints_env(name, default=""):
 
 def _float_env(name, default="0"):
     try:
-        return float(os.getenv(name, default))
+        return float(_ENV.get(name, default))
     except (TypeError, ValueError):
         return float(default)
 
 
 def _int_env(name, default="0"):
     try:
-        return int(os.getenv(name, default))
+        return int(_ENV.get(name, default))
     except (TypeError, ValueError):
         return int(default)
 
@@ -46,30 +51,34 @@ class BaseConfig:
     ENV_NAME = "base"
     JSON_AS_ASCII = False
 
-    AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "").strip()
+    AUTH_TOKEN = _ENV.get("TWILIO_AUTH_TOKEN", "").strip()
 
-    TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "").strip()
-    TWILIO_AUTH_TOKEN_REST = os.getenv("TWILIO_AUTH_TOKEN_REST", "").strip() or AUTH_TOKEN
-    TWILIO_FROM = os.getenv("TWILIO_WHATSAPP_FROM", "").strip()
+    TWILIO_ACCOUNT_SID = _ENV.get("TWILIO_ACCOUNT_SID", "").strip()
+    TWILIO_AUTH_TOKEN_REST = _ENV.get("TWILIO_AUTH_TOKEN_REST", "").strip() or AUTH_TOKEN
+    TWILIO_FROM = _ENV.get("TWILIO_WHATSAPP_FROM", "").strip()
     TWILIO_POST_RETRY_ATTEMPTS = _int_env("TWILIO_POST_RETRY_ATTEMPTS", "2")
     TWILIO_POST_RETRY_BACKOFF_SECONDS = _float_env("TWILIO_POST_RETRY_BACKOFF_SECONDS", "0.3")
-
-    DF_PROJECT = os.getenv("DF_PROJECT_ID", "").strip()
-    DF_LOCATION = os.getenv("DF_LOCATION", "global").strip()
-    DF_AGENT_ID = os.getenv("DF_AGENT_ID", "").strip()
-    LANG_CODE = os.getenv("DF_LANG_CODE", "pt-br").strip()
+    TWILIO_POST_RETRY_MAX_DELAY = _float_env("TWILIO_POST_RETRY_MAX_DELAY", "30.0")
+    TWILIO_BREAKER_THRESHOLD = _int_env("TWILIO_BREAKER_THRESHOLD", "5")
+    TWILIO_BREAKER_COOLDOWN_SECONDS = _float_env("TWILIO_BREAKER_COOLDOWN_SECONDS", "10.0")
+    TWILIO_RATE_PER_SEC = _float_env("TWILIO_RATE_PER_SEC", "70")
+
+    DF_PROJECT = _ENV.get("DF_PROJECT_ID", "").strip()
+    DF_LOCATION = _ENV.get("DF_LOCATION", "global").strip()
+    DF_AGENT_ID = _ENV.get("DF_AGENT_ID", "").strip()
+    LANG_CODE = _ENV.get("DF_LANG_CODE", "pt-br").strip()
     CX_TIMEOUT_SECONDS = _float_env("CX_TIMEOUT_SECONDS", "15.0")
     CX_RETRY_ATTEMPTS = _int_env("CX_RETRY_ATTEMPTS", "3")
 
-    DF_HANDOFF_PARAM = (os.getenv("DF_HANDOFF_PARAM", "handoff_request") or "").strip()
-    DF_HANDOFF_MARKER = os.getenv("DF_HANDOFF_MARKER", "##HANDOFF_TRIGGER##")
+    DF_HANDOFF_PARAM = (_ENV.get("DF_HANDOFF_PARAM", "handoff_request") or "").strip()
+    DF_HANDOFF_MARKER = _ENV.get("DF_HANDOFF_MARKER", "##HANDOFF_TRIGGER##")
     FEATURE_AUTOREPLY_DURING_PENDING = _bool_env("FEATURE_AUTOREPLY_DURING_PENDING", "false")
-    HANDOFF_ACK_TEXT = os.getenv(
+    HANDOFF_ACK_TEXT = _ENV.get(
         "HANDOFF_ACK_TEXT",
         "Certo! Um atendente vai assumir esta conversa em instantes."
     )
     FEATURE_DISABLE_HANDOFF = _bool_env("FEATURE_DISABLE_HANDOFF", "false")
-    HANDOFF_DISABLED_TEXT = os.getenv(
+    HANDOFF_DISABLED_TEXT = _ENV.get(
         "HANDOFF_DISABLED_TEXT",
         "Atendimento humano temporariamente indisponível. "
         "Você pode deixar sua mensagem por aqui e responderemos assim que possível."
@@ -94,23 +103,25 @@ class BaseConfig:
         )
     )
 
-    FS_CONV_COLL = os.getenv("FS_CONV_COLL", "conversations").strip()
-    FS_MSG_SUBCOLL = os.getenv("FS_MSG_SUBCOLL", "messages").strip()
+    FS_CONV_COLL = _ENV.get("FS_CONV_COLL", "conversations").strip()
+    FS_MSG_SUBCOLL = _ENV.get("FS_MSG_SUBCOLL", "messages").strip()
+    CONV_CACHE_TTL_SECONDS = _float_env("CONV_CACHE_TTL_SECONDS", "0")
 
     MESSAGE_DEBOUNCE_INITIAL_SECONDS = _float_env("MESSAGE_DEBOUNCE_INITIAL_SECONDS", "5.0")
     MESSAGE_DEBOUNCE_EXTEND_SECONDS = _float_env("MESSAGE_DEBOUNCE_EXTEND_SECONDS", "3.0")
     MESSAGE_DEBOUNCE_MAX_SECONDS = _float_env("MESSAGE_DEBOUNCE_MAX_SECONDS", "10.0")
     FEATURE_MESSAGE_AGGREGATION = _bool_env("FEATURE_MESSAGE_AGGREGATION", "true")
+    WEBHOOK_WORKERS = _int_env("WEBHOOK_WORKERS", "32")
 
     FEATURE_AUDIO_TRANSCRIPTION = _bool_env("FEATURE_AUDIO_TRANSCRIPTION", "true")
-    STT_LANGUAGE_CODE = os.getenv("STT_LANGUAGE_CODE", "pt-BR").strip()
+    STT_LANGUAGE_CODE = _ENV.get("STT_LANGUAGE_CODE", "pt-BR").strip()
     STT_TIMEOUT_SECONDS = _float_env("STT_TIMEOUT_SECONDS", "30.0")
-    STT_FALLBACK_TEXT = os.getenv(
+    STT_FALLBACK_TEXT = _ENV.get(
         "STT_FALLBACK_TEXT",
         "[Audio recebido, mas nao foi possivel transcrever. Pode repetir por texto?]",
     ).strip()
 
-    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_LEVEL = _ENV.get("LOG_LEVEL", "INFO").upper()
 
 
 class DevelopmentConfig(BaseConfig):
@@ -133,8 +144,9 @@ class TestingConfig(BaseConfig):
     TESTING = True
 
 
+@functools.lru_cache(maxsize=1)
 def get_config():
-    env = (os.getenv("APP_ENV") or os.getenv("FLASK_ENV") or "production").strip().lower()
+    env = (_ENV.get("APP_ENV") or _ENV.get("FLASK_ENV") or "production").strip().lower()
     if env in ("development", "dev", "local"):
         return DevelopmentConfig
     if env in ("staging", "stage"):
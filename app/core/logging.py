@@ -1,5 +1,21 @@
-﻿import json
-import logging
+﻿import logging
+
+import orjson
+
+
+class _LazyJSON:
+    """Serializa o payload de log_event so quando o record e de fato formatado."""
+
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        try:
+            return orjson.dumps(self.payload).decode()
+        except Exception:
+            return repr(self.payload)
 
 
 def setup_logging(app):
@@ -8,9 +24,12 @@ def setup_logging(app):
 
 
 def log_event(action, **kw):
+    logger = logging.getLogger("webh")
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
         payload = {"component": "webh", "action": action}
         payload.update({k: v for k, v in kw.items() if v is not None})
-        logging.getLogger("webh").info(json.dumps(payload, ensure_ascii=False))
+        logger.info("%s", _LazyJSON(payload))
     except Exception:
         pass
@@ -1,19 +1,33 @@
-﻿import requests
+﻿import logging
+import threading
+
+import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from google.cloud import firestore
-from google.cloud import dialogflowcx_v3 as dfcx
-from google.cloud import speech
-from google.api_core.client_options import ClientOptions
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+# Os SDKs do Google Cloud (gRPC, protobuf, auth) sao importados e instanciados
+# sob demanda nos getters: /healthz e o boot do worker nao pagam esse custo.
 http_session = None
 fs = None
 df_client = None
 speech_client = None
-
-
-def _get_retry_session(retries=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)):
+fs_repo = None
+
+_df_location = "global"
+_fs_collections = ("conversations", "messages")
+_conv_cache_ttl = 0.0
+_speech_init_failed = False
+_clients_lock = threading.Lock()
+
+
+def _get_retry_session(
+    retries=3,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    pool_connections=32,
+    pool_maxsize=64,
+):
     """Session with retry for transient errors."""
     session = requests.Session()
     retry = Retry(
@@ -25,32 +39,31 @@ def _get_retry_session(retries=3, backoff_factor=0.5, status_forcelist=(500, 502
         allowed_methods=["GET"],
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=False,
+    )
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     return session
 
 
 def init_extensions(app):
-    global http_session, fs, df_client, speech_client
+    global http_session, _df_location, _fs_collections, _conv_cache_ttl
 
     if http_session is None:
-        http_session = _get_retry_session()
-    if fs is None:
-        fs = firestore.Client()
-
-    df_location = app.config.get("DF_LOCATION", "global")
-    endpoint = f"{df_location}-dialogflow.googleapis.com"
-    df_client = dfcx.SessionsClient(client_options=ClientOptions(api_endpoint=endpoint))
+        # Uma conexao por worker em envios simultaneos, sem fila no pool.
+        workers = int(app.config.get("WEBHOOK_WORKERS", 32) or 32)
+        http_session = _get_retry_session(pool_maxsize=max(64, workers))
 
-    if speech_client is None:
-        try:
-            speech_client = speech.SpeechClient()
-        except Exception as exc:
-            app.logger.error("Falha ao inicializar SpeechClient: %s", exc, exc_info=True)
-            speech_client = None
+    _df_location = app.config.get("DF_LOCATION", "global")
+    _fs_collections = (app.config["FS_CONV_COLL"], app.config["FS_MSG_SUBCOLL"])
+    _conv_cache_ttl = float(app.config.get("CONV_CACHE_TTL_SECONDS", 0.0))
 
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+    if not isinstance(app.wsgi_app, ProxyFix):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
 
 def get_http_session():
@@ -58,12 +71,51 @@ def get_http_session():
 
 
 def get_fs():
+    global fs
+    if fs is None:
+        with _clients_lock:
+            if fs is None:
+                from google.cloud import firestore
+
+                fs = firestore.Client()
     return fs
 
 
+def get_fs_repo():
+    global fs_repo
+    if fs_repo is None:
+        client = get_fs()
+        with _clients_lock:
+            if fs_repo is None:
+                from app.repositories.firestore_repo import FirestoreRepository
+
+                fs_repo = FirestoreRepository(client, *_fs_collections, conv_cache_ttl=_conv_cache_ttl)
+    return fs_repo
+
+
 def get_df_client():
+    global df_client
+    if df_client is None:
+        with _clients_lock:
+            if df_client is None:
+                from google.api_core.client_options import ClientOptions
+                from google.cloud import dialogflowcx_v3 as dfcx
+
+                endpoint = f"{_df_location}-dialogflow.googleapis.com"
+                df_client = dfcx.SessionsClient(client_options=ClientOptions(api_endpoint=endpoint))
     return df_client
 
 
 def get_speech_client():
+    global speech_client, _speech_init_failed
+    if speech_client is None and not _speech_init_failed:
+        with _clients_lock:
+            if speech_client is None and not _speech_init_failed:
+                try:
+                    from google.cloud import speech
+
+                    speech_client = speech.SpeechClient()
+                except Exception as exc:
+                    logging.error("Falha ao inicializar SpeechClient: %s", exc, exc_info=True)
+                    _speech_init_failed = True
     return speech_client
@@ -1,13 +1,94 @@
-﻿import uuid
+﻿import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 
+from google.api_core import exceptions as gexc
 from google.cloud import firestore
 
 
+def _deep_merge(old: dict, fields: dict) -> dict:
+    # Igual ao set(merge=True) do Firestore: mapas aninhados (ex.:
+    # session_parameters) sao mesclados campo a campo, nao substituidos.
+    merged = dict(old)
+    for key, value in fields.items():
+        prev = merged.get(key)
+        if isinstance(value, dict) and isinstance(prev, dict):
+            merged[key] = _deep_merge(prev, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class _TTLCache:
+    """Cache LRU com expiracao, seguro entre threads."""
+
+    __slots__ = ("ttl", "maxsize", "_data", "_lock")
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def merge(self, key, fields: dict):
+        # Novo dict (sem mutar o anterior, que pode estar em uso) e mesmo prazo.
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data[key] = (item[0], _deep_merge(item[1], fields))
+
+
 class FirestoreRepository:
-    def __init__(self, client, conv_coll, msg_subcoll):
+    __slots__ = ("client", "conv_coll", "msg_subcoll", "_conv_cache", "_pending_merges")
+
+    def __init__(self, client, conv_coll, msg_subcoll, conv_cache_ttl: float = 0.0, conv_cache_size: int = 20000):
         self.client = client
         self.conv_coll = conv_coll
         self.msg_subcoll = msg_subcoll
+        # Mensagens seguidas do mesmo usuario nao releem a conversa. O TTL limita
+        # quanto tempo uma mudanca feita fora daqui (ex.: CRM assumindo) demora
+        # a ser vista; 0 desativa.
+        self._conv_cache = _TTLCache(conv_cache_ttl, conv_cache_size) if conv_cache_ttl > 0 else None
+        # id(batch) -> [(conversation_id, fields)] a aplicar no cache apos o commit.
+        self._pending_merges = {}
+
+    @contextmanager
+    def batched(self):
+        """WriteBatch com commit unico na saida do bloco."""
+        batch = self.client.batch()
+        pending = self._pending_merges[id(batch)] = []
+        try:
+            yield batch
+            batch.commit()
+        finally:
+            self._pending_merges.pop(id(batch), None)
+        # So o que de fato foi gravado entra no cache.
+        for conversation_id, fields in pending:
+            self._conv_cache.merge(conversation_id, fields)
 
     def _conv_ref(self, conversation_id: str):
         return self.client.collection(self.conv_coll).document(conversation_id)
@@ -15,11 +96,21 @@ class FirestoreRepository:
     def _msg_ref(self, conversation_id: str, message_id: str):
         return self._conv_ref(conversation_id).collection(self.msg_subcoll).document(message_id)
 
-    def ensure_conversation(self, conversation_id: str, session_id: str):
+    def ensure_conversation(self, conversation_id: str, session_id: str) -> tuple[dict, bool]:
+        """Retorna (dados da conversa, ja_existia), criando o documento se preciso."""
+        cache = self._conv_cache
+        if cache is not None:
+            cached = cache.get(conversation_id)
+            if cached is not None:
+                return dict(cached), True
+
         ref = self._conv_ref(conversation_id)
         snap = ref.get()
         if snap.exists:
-            return snap, True
+            data = snap.to_dict() or {}
+            if cache is not None:
+                cache.set(conversation_id, dict(data))
+            return data, True
 
         data = {
             "conversation_id": conversation_id,
@@ -36,8 +127,16 @@ class FirestoreRepository:
             "updated_at": firestore.SERVER_TIMESTAMP,
             "lock_version": 0,
         }
-        ref.set(data)
-        return ref.get(), False
+        try:
+            ref.create(data)
+        except gexc.AlreadyExists:
+            # Outro webhook criou a conversa entre o get() e o create().
+            return ref.get().to_dict() or {}, True
+        # Recem-criada: os dados sao os que acabamos de gravar, sem reler. Os
+        # timestamps ficam como sentinela, e nenhum leitor de conv_data os usa.
+        if cache is not None:
+            cache.set(conversation_id, dict(data))
+        return data, False
 
     def add_message_if_new(
         self,
@@ -48,13 +147,11 @@ class FirestoreRepository:
         text: str,
         media_url: str = None,
         media_type: str = None,
+        batch=None,
     ) -> bool:
         if not message_id:
             message_id = str(uuid.uuid4())
         ref = self._msg_ref(conversation_id, message_id)
-        if ref.get().exists:
-            return False
-
         msg_data = {
             "message_id": message_id,
             "direction": direction,
@@ -68,7 +165,15 @@ class FirestoreRepository:
         if media_type:
             msg_data["media_type"] = media_type
 
-        ref.set(msg_data)
+        if batch is not None:
+            batch.create(ref, msg_data)
+            return True
+
+        # create() falha se o documento ja existe: idempotencia em um unico RTT.
+        try:
+            ref.create(msg_data)
+        except gexc.AlreadyExists:
+            return False
         return True
 
     def message_exists(self, conversation_id: str, message_id: str) -> bool:
@@ -76,9 +181,23 @@ class FirestoreRepository:
             return False
         return self._msg_ref(conversation_id, message_id).get().exists
 
-    def update_conversation(self, conversation_id: str, **fields):
+    def update_conversation(self, conversation_id: str, *, batch=None, **fields):
         fields["updated_at"] = firestore.SERVER_TIMESTAMP
-        self._conv_ref(conversation_id).set(fields, merge=True)
+        cache = self._conv_cache
+        ref = self._conv_ref(conversation_id)
+        if batch is not None:
+            batch.set(ref, fields, merge=True)
+            if cache is not None:
+                pending = self._pending_merges.get(id(batch))
+                if pending is not None:
+                    pending.append((conversation_id, fields))
+                else:
+                    # Batch de fora de batched(): sem como saber do commit.
+                    cache.pop(conversation_id)
+            return
+        ref.set(fields, merge=True)
+        if cache is not None:
+            cache.merge(conversation_id, fields)
 
     def update_message(self, conversation_id: str, message_id: str, **fields):
         if not message_id:
@@ -1,12 +1,16 @@
-﻿import logging
+﻿import functools
+import logging
 from collections.abc import Mapping
 import random
+import threading
 import time
 
 from google.api_core import exceptions as gexc
 from google.cloud import dialogflowcx_v3 as dfcx
 from google.protobuf.struct_pb2 import Struct, Value
-from google.protobuf.json_format import MessageToDict
+from google.protobuf.json_format import MessageToDict, ParseDict
+
+_req_local = threading.local()
 
 _TRANSIENT_DF_ERRORS = (
     gexc.InternalServerError,
@@ -17,83 +21,107 @@ _TRANSIENT_DF_ERRORS = (
 )
 
 
+def _value_scalar(value, kind):
+    if kind == "number_value":
+        return value.number_value
+    if kind == "string_value":
+        return value.string_value
+    if kind == "bool_value":
+        return value.bool_value
+    return None
+
+
 def struct_to_dict(obj):
     if obj is None:
         return {}
 
-    if hasattr(obj, "_pb"):
-        obj = obj._pb
+    # Percurso iterativo com pilha explicita de (container, chave, valor, raiz):
+    # parametros muito aninhados nao custam frames Python nem RecursionError.
+    holder = [None]
+    stack = [(holder, 0, obj, True)]
+    while stack:
+        container, key, value, is_root = stack.pop()
+        if hasattr(value, "_pb"):
+            value = value._pb
+
+        if isinstance(value, Struct):
+            try:
+                container[key] = MessageToDict(value, preserving_proto_field_name=True)
+                continue
+            except Exception as exc:
+                logging.warning("MessageToDict failed for Struct: %s", exc)
+
+        if isinstance(value, Value):
+            kind = value.WhichOneof("kind")
+            if kind == "struct_value":
+                stack.append((container, key, value.struct_value, False))
+            elif kind == "list_value":
+                items = value.list_value.values
+                out = [None] * len(items)
+                container[key] = out
+                stack.extend((out, i, item, False) for i, item in enumerate(items))
+            else:
+                container[key] = _value_scalar(value, kind)
+            continue
+
+        if isinstance(value, Mapping):
+            out = {}
+            container[key] = out
+            for k, v in value.items():
+                out[k] = None
+                stack.append((out, k, v, False))
+            continue
+
+        if is_root:
+            logging.warning("struct_to_dict received unexpected type: %s", type(value).__name__)
+            container[key] = {}
+        else:
+            container[key] = value
+
+    return holder[0]
+
+
+_CX_PARAM_PATHS = (
+    ("query_result", "parameters"),
+    ("query_result", "session_info", "parameters"),
+    ("session_info", "parameters"),
+)
 
-    if isinstance(obj, Struct):
-        try:
-            return MessageToDict(obj, preserving_proto_field_name=True)
-        except Exception as exc:
-            logging.warning(f"MessageToDict failed for Struct: {exc}")
 
-    if isinstance(obj, Value):
-        kind = obj.WhichOneof("kind")
-        if kind == "null_value":
+def _get_attr_path(root, path):
+    obj = root
+    for attr in path:
+        obj = getattr(obj, attr, None)
+        if not obj:
             return None
-        if kind == "number_value":
-            return obj.number_value
-        if kind == "string_value":
-            return obj.string_value
-        if kind == "bool_value":
-            return obj.bool_value
-        if kind == "struct_value":
-            return struct_to_dict(obj.struct_value)
-        if kind == "list_value":
-            return [struct_to_dict(v) for v in obj.list_value.values]
-        return None
-
-    if isinstance(obj, Mapping):
-        def cv(value):
-            if hasattr(value, "_pb"):
-                value = value._pb
-            if isinstance(value, (Struct, Value)):
-                return struct_to_dict(value)
-            if isinstance(value, Mapping):
-                return struct_to_dict(value)
-            return value
-
-        return {k: cv(v) for k, v in obj.items()}
-
-    logging.warning(f"struct_to_dict received unexpected type: {type(obj).__name__}")
-    return {}
+    return obj
 
 
 def cx_all_params_dict(resp) -> dict:
+    # Percorre o protobuf cru: cada Struct vira dict em uma chamada de
+    # MessageToDict, sem o marshaling do proto-plus a cada nivel.
+    root = getattr(resp, "_pb", resp)
     out = {}
-    try:
-        qr = getattr(resp, "query_result", None)
-        if qr and getattr(qr, "parameters", None):
-            out.update(struct_to_dict(qr.parameters) or {})
-    except Exception:
-        pass
-
-    try:
-        qr = getattr(resp, "query_result", None)
-        si = getattr(qr, "session_info", None) if qr else None
-        if si and getattr(si, "parameters", None):
-            out.update(struct_to_dict(si.parameters) or {})
-    except Exception:
-        pass
-
-    try:
-        si2 = getattr(resp, "session_info", None)
-        if si2 and getattr(si2, "parameters", None):
-            out.update(struct_to_dict(si2.parameters) or {})
-    except Exception:
-        pass
-
+    for path in _CX_PARAM_PATHS:
+        try:
+            params = _get_attr_path(root, path)
+            if params:
+                out.update(struct_to_dict(params) or {})
+        except Exception:
+            pass
     return out
 
 
+@functools.lru_cache(maxsize=8)
+def _session_prefix(project, location, agent_id) -> str:
+    # Chave sao os valores atuais da config: um override em app.config (ex.:
+    # testes) ganha seu proprio prefixo.
+    return f"projects/{project}/locations/{location}/agents/{agent_id}/sessions/"
+
+
 def _cx_session_path(settings, session_id: str) -> str:
-    return (
-        f"projects/{settings.get('DF_PROJECT')}/locations/{settings.get('DF_LOCATION')}"
-        f"/agents/{settings.get('DF_AGENT_ID')}/sessions/{session_id}"
-    )
+    prefix = _session_prefix(settings.get("DF_PROJECT"), settings.get("DF_LOCATION"), settings.get("DF_AGENT_ID"))
+    return prefix + session_id
 
 
 def detect_intent_text(
@@ -109,50 +137,41 @@ def detect_intent_text(
 ):
     session = _cx_session_path(settings, session_id)
 
-    query_params = dfcx.QueryParameters()
-    has_params = False
+    # Uma requisicao protobuf por thread, reaproveitada: a cada turno so os
+    # campos abaixo sao trocados, sem alocar a arvore de mensagens de novo.
+    pb = getattr(_req_local, "req", None)
+    if pb is None:
+        pb = _req_local.req = dfcx.DetectIntentRequest.pb()()
+    pb.session = session
+    pb.query_input.text.text = text
+    pb.query_input.language_code = settings.get("LANG_CODE", "pt-br")
+    pb.ClearField("query_params")
+    req = dfcx.DetectIntentRequest.wrap(pb)
 
     if user_id or session_params:
-        params_struct = Struct()
-
+        # None/bool seguem tipados; o resto vai como string. ParseDict preenche
+        # o Struct da propria requisicao, sem Struct intermediario para copiar.
+        fields = {}
         if user_id:
-            params_struct.fields["user_id"].string_value = user_id
-            has_params = True
-
-        if session_params:
-            for key, value in session_params.items():
-                if value is None:
-                    params_struct.fields[key].null_value = 0
-                elif isinstance(value, bool):
-                    params_struct.fields[key].bool_value = value
-                else:
-                    params_struct.fields[key].string_value = str(value)
-            has_params = True
-
-        if has_params:
-            query_params.parameters = params_struct
-            logging.info(f"CX QueryParams: user_id={user_id}, extras={session_params}")
-
-    req = dfcx.DetectIntentRequest(
-        session=session,
-        query_input=dfcx.QueryInput(
-            text=dfcx.TextInput(text=text),
-            language_code=settings.get("LANG_CODE", "pt-br"),
-        ),
-        query_params=query_params if has_params else None,
-    )
+            fields["user_id"] = user_id
+        for key, value in (session_params or {}).items():
+            fields[key] = value if value is None or isinstance(value, bool) else str(value)
+
+        ParseDict(fields, pb.query_params.parameters)
+        logging.info("CX QueryParams: user_id=%s, extras=%s", user_id, session_params)
 
     attempts = max(1, int(attempts or 1))
     last_exc = None
     for i in range(attempts):
         try:
             resp = df_client.detect_intent(request=req, timeout=timeout_s)
-            texts = []
-            for msg in resp.query_result.response_messages:
-                if msg.text and msg.text.text:
-                    for piece in msg.text.text:
-                        if piece:
-                            texts.append(piece)
+            texts = [
+                piece
+                for msg in resp.query_result.response_messages
+                if msg.text
+                for piece in msg.text.text
+                if piece
+            ]
             return texts, resp
         except _TRANSIENT_DF_ERRORS as exc:
             last_exc = exc
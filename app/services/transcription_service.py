@@ -1,3 +1,5 @@
+import functools
+import io
 import logging
 
 import requests
@@ -6,7 +8,6 @@ from google.cloud import speech
 
 _ENCODING_MAP = {
     "audio/ogg": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
-    "audio/ogg; codecs=opus": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
     "audio/opus": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
     "application/ogg": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
     "audio/mpeg": speech.RecognitionConfig.AudioEncoding.MP3,
@@ -28,10 +29,18 @@ _SAMPLE_RATE_MAP = {
 }
 
 _OPUS_SAMPLE_RATE_CANDIDATES = (16000, 24000, 12000, 48000, 8000)
+_OPUS_HEAD_MAGIC = b"OpusHead"
+_OPUS_HEAD_SCAN_BYTES = 200
+_MEDIA_CHUNK_BYTES = 64 * 1024
+
+
+@functools.lru_cache(maxsize=64)
+def _normalize_media(media_type: str) -> str:
+    return media_type.split(";")[0].strip().lower()
 
 
 def is_audio_media_type(media_type: str | None) -> bool:
-    normalized = (media_type or "").split(";")[0].strip().lower()
+    normalized = _normalize_media(media_type or "")
     return normalized.startswith("audio/") or normalized == "application/ogg"
 
 
@@ -39,10 +48,7 @@ def _resolve_encoding(media_type: str | None):
     if not media_type:
         return speech.RecognitionConfig.AudioEncoding.OGG_OPUS, _SAMPLE_RATE_MAP[speech.RecognitionConfig.AudioEncoding.OGG_OPUS]
 
-    media_type_raw = media_type.strip().lower()
-    media_type_normalized = media_type_raw.split(";")[0].strip()
-
-    encoding = _ENCODING_MAP.get(media_type_raw) or _ENCODING_MAP.get(media_type_normalized)
+    encoding = _ENCODING_MAP.get(_normalize_media(media_type))
     if not encoding:
         logging.warning("Content-type de audio nao mapeado (%s). Fallback OGG_OPUS.", media_type)
         encoding = speech.RecognitionConfig.AudioEncoding.OGG_OPUS
@@ -50,6 +56,16 @@ def _resolve_encoding(media_type: str | None):
     return encoding, _SAMPLE_RATE_MAP.get(encoding)
 
 
+def _opus_input_rate(content: bytes) -> int | None:
+    # O header de identificacao Opus fica na primeira pagina Ogg:
+    # "OpusHead" + versao(1) + canais(1) + pre-skip(2) + input sample rate (LE32).
+    idx = content.find(_OPUS_HEAD_MAGIC, 0, _OPUS_HEAD_SCAN_BYTES)
+    if idx < 0 or len(content) < idx + 16:
+        return None
+    rate = int.from_bytes(content[idx + 12:idx + 16], "little")
+    return rate if rate in _OPUS_SAMPLE_RATE_CANDIDATES else None
+
+
 def download_twilio_media(media_url: str, account_sid: str, auth_token: str, *, http_session):
     if not media_url:
         raise ValueError("media_url vazio")
@@ -58,14 +74,21 @@ def download_twilio_media(media_url: str, account_sid: str, auth_token: str, *,
 
     session = http_session or requests.Session()
 
-    resp = session.get(
+    # stream=True evita manter o corpo duas vezes em memoria (buffer urllib3 + .content).
+    with session.get(
         media_url,
         auth=(account_sid, auth_token),
         timeout=30,
-    )
-    resp.raise_for_status()
-
-    content = resp.content or b""
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        # O protobuf do STT so aceita bytes. BytesIO.getvalue() devolve o proprio
+        # buffer interno sem copiar, ao contrario de bytes(bytearray).
+        buf = io.BytesIO()
+        for chunk in resp.iter_content(chunk_size=_MEDIA_CHUNK_BYTES):
+            buf.write(chunk)
+
+    content = buf.getvalue()
     if len(content) < 64:
         raise ValueError(f"conteudo de audio muito pequeno: {len(content)} bytes")
 
@@ -82,13 +105,16 @@ def _extract_transcript_text(response):
     if not response or not response.results:
         return ""
 
-    out = []
-    for result in response.results:
-        if result.alternatives:
-            text = (result.alternatives[0].transcript or "").strip()
-            if text:
-                out.append(text)
-    return " ".join(out).strip()
+    return " ".join(
+        filter(
+            None,
+            (
+                (result.alternatives[0].transcript or "").strip()
+                for result in response.results
+                if result.alternatives
+            ),
+        )
+    ).strip()
 
 
 def transcribe_audio(
@@ -113,8 +139,14 @@ def transcribe_audio(
 
     attempts = []
     if encoding == speech.RecognitionConfig.AudioEncoding.OGG_OPUS:
+        # A taxa do OpusHead vai primeiro; as demais candidatas seguem como
+        # fallback se o STT rejeitar ou nao transcrever nada.
+        header_rate = _opus_input_rate(audio_content)
+        if header_rate:
+            attempts.append({**config_data, "sample_rate_hertz": header_rate})
         for rate in _OPUS_SAMPLE_RATE_CANDIDATES:
-            attempts.append({**config_data, "sample_rate_hertz": rate})
+            if rate != header_rate:
+                attempts.append({**config_data, "sample_rate_hertz": rate})
     else:
         if sample_rate:
             attempts.append({**config_data, "sample_rate_hertz": sample_rate})
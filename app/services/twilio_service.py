@@ -1,14 +1,134 @@
-﻿import json
+﻿import functools
 import logging
+import random
+import re
+import threading
 import time
+from dataclasses import dataclass
 
+import orjson
 import requests
 from requests import exceptions as req_exc
+from requests.adapters import HTTPAdapter
 
+# Extrai so o "sid" de nivel superior da resposta; "account_sid" etc. nao casam
+# porque a chave precisa comecar com aspas.
+_SID_RE = re.compile(rb'"sid"\s*:\s*"([^"]+)"')
 
-def _get_retry_settings(settings):
-    attempts = settings.get("TWILIO_POST_RETRY_ATTEMPTS", 2)
-    backoff = settings.get("TWILIO_POST_RETRY_BACKOFF_SECONDS", 0.3)
+# Respostas de erro (HTML de proxy, 429 com trace) so sao lidas ate aqui para log.
+_ERROR_BODY_MAX_BYTES = 4096
+_ERROR_LOG_MAX_CHARS = 2048
+
+
+@dataclass(frozen=True, slots=True)
+class TwilioConfig:
+    account_sid: str
+    auth_token: str
+    from_number: str
+    url: str
+    auth: tuple[str, str]
+    has_credentials: bool
+
+
+# Circuit breaker por processo: apos falhas transitorias consecutivas, os envios
+# falham na hora ate o fim do cooldown em vez de gastar tentativas + sleeps.
+_BREAKER = {"fails": 0, "open_until": 0.0, "lock": threading.Lock()}
+
+
+class _Bucket:
+    """Token bucket por processo: segura os envios antes de estourar o limite
+    de mensagens por segundo em vez de depender de 429 + retry."""
+
+    __slots__ = ("rate", "capacity", "tokens", "last", "lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: float = 1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+@functools.lru_cache(maxsize=4)
+def _build_bucket(raw_rate) -> _Bucket | None:
+    # Chave e o valor cru da config: o parse roda uma vez por valor.
+    try:
+        rate = float(raw_rate)
+    except (TypeError, ValueError):
+        rate = 70.0
+    if rate <= 0:
+        return None
+    return _Bucket(rate=rate, capacity=max(1.0, rate))
+
+
+def _bucket(settings) -> _Bucket | None:
+    return _build_bucket(settings.get("TWILIO_RATE_PER_SEC", 70))
+
+
+_DEFAULT_SESSION = None
+_default_session_lock = threading.Lock()
+
+
+def _get_default_session():
+    # Fallback quando o chamador nao passa http_session: uma sessao por processo
+    # mantem o keep-alive/TLS com api.twilio.com entre envios.
+    global _DEFAULT_SESSION
+    if _DEFAULT_SESSION is None:
+        with _default_session_lock:
+            if _DEFAULT_SESSION is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, pool_block=False)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _DEFAULT_SESSION = session
+    return _DEFAULT_SESSION
+
+
+@functools.lru_cache(maxsize=8)
+def _build_twilio_config(account_sid: str, auth_token: str, from_number: str) -> TwilioConfig:
+    return TwilioConfig(
+        account_sid=account_sid,
+        auth_token=auth_token,
+        from_number=from_number,
+        url=f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json",
+        auth=(account_sid, auth_token),
+        has_credentials=bool(account_sid and auth_token),
+    )
+
+
+def _twilio_config(settings) -> TwilioConfig:
+    # Flask Config e um dict (nao hashable): o cache fica nas strings resolvidas.
+    return _build_twilio_config(
+        (settings.get("TWILIO_ACCOUNT_SID") or "").strip(),
+        (settings.get("TWILIO_AUTH_TOKEN_REST") or settings.get("AUTH_TOKEN") or "").strip(),
+        (settings.get("TWILIO_FROM") or "").strip(),
+    )
+
+
+def _response_sid(resp) -> str | None:
+    match = _SID_RE.search(resp.content or b"")
+    return match.group(1).decode() if match else None
+
+
+@functools.lru_cache(maxsize=512)
+def _encode_content_vars(user_name: str) -> str:
+    return orjson.dumps({"user_name": user_name, "1": user_name}).decode()
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_retry_settings(attempts, backoff, max_delay):
+    # Chave sao os valores crus da config: o parse roda uma vez por combinacao
+    # e uma config alterada em runtime ganha sua propria entrada.
     try:
         attempts = int(attempts)
     except (TypeError, ValueError):
@@ -17,37 +137,220 @@ def _get_retry_settings(settings):
         backoff = float(backoff)
     except (TypeError, ValueError):
         backoff = 0.3
+    try:
+        max_delay = float(max_delay)
+    except (TypeError, ValueError):
+        max_delay = 30.0
     attempts = max(1, attempts)
     backoff = max(0.0, backoff)
-    return attempts, backoff
+    max_delay = max(0.0, max_delay)
+    return attempts, backoff, max_delay
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_breaker_settings(threshold, cooldown):
+    try:
+        threshold = int(threshold)
+    except (TypeError, ValueError):
+        threshold = 5
+    try:
+        cooldown = float(cooldown)
+    except (TypeError, ValueError):
+        cooldown = 10.0
+    return max(1, threshold), max(0.0, cooldown)
+
+
+def _get_retry_settings(settings):
+    return _parse_retry_settings(
+        settings.get("TWILIO_POST_RETRY_ATTEMPTS", 2),
+        settings.get("TWILIO_POST_RETRY_BACKOFF_SECONDS", 0.3),
+        settings.get("TWILIO_POST_RETRY_MAX_DELAY", 30.0),
+    )
+
+
+def _get_breaker_settings(settings):
+    return _parse_breaker_settings(
+        settings.get("TWILIO_BREAKER_THRESHOLD", 5),
+        settings.get("TWILIO_BREAKER_COOLDOWN_SECONDS", 10.0),
+    )
+
+
+def _breaker_record_success():
+    if _BREAKER["fails"]:
+        with _BREAKER["lock"]:
+            _BREAKER["fails"] = 0
+            _BREAKER["open_until"] = 0.0
+
+
+def _breaker_record_failure(threshold, cooldown):
+    with _BREAKER["lock"]:
+        _BREAKER["fails"] += 1
+        if _BREAKER["fails"] >= threshold:
+            _BREAKER["open_until"] = time.monotonic() + cooldown
+            logging.error(
+                "Circuit breaker Twilio aberto por %.1fs apos %d falhas transitorias consecutivas",
+                cooldown,
+                _BREAKER["fails"],
+            )
 
 
 def _is_transient_post_error(exc: Exception) -> bool:
-    return isinstance(exc, (req_exc.SSLError, req_exc.ConnectionError, req_exc.Timeout))
-
-
-def _post_with_retry(*, session, url, data, auth, timeout, attempts, backoff):
-    last_exc = None
-    for attempt in range(1, attempts + 1):
-        try:
-            resp = session.post(url, data=data, auth=auth, timeout=timeout)
-            resp.raise_for_status()
-            return resp
-        except req_exc.RequestException as exc:
-            last_exc = exc
-            if not _is_transient_post_error(exc) or attempt >= attempts:
+    if isinstance(exc, (req_exc.SSLError, req_exc.ConnectionError, req_exc.Timeout)):
+        return True
+    if isinstance(exc, req_exc.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        return status == 429 or 500 <= status < 600
+    return False
+
+
+def _is_retryable_post_error(exc: Exception) -> bool:
+    # 5xx conta para o breaker mas nao e repetido: a mensagem pode ja ter sido
+    # criada no Twilio. Um 429 garante que nada foi criado.
+    if isinstance(exc, req_exc.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429
+    return _is_transient_post_error(exc)
+
+
+def _retry_after_seconds(exc: Exception) -> float:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", 0)))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _content_length(resp) -> int | None:
+    try:
+        return int(resp.headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _session_post(session, url, *, data, auth, timeout):
+    resp = session.post(url, data=data, auth=auth, timeout=timeout, stream=True)
+    if resp.status_code >= 400:
+        length = _content_length(resp)
+        if length is None or length > _ERROR_BODY_MAX_BYTES:
+            # Corpo grande ou sem tamanho (HTML de proxy): le so o inicio para
+            # o log e fecha, sem baixar o resto.
+            try:
+                snippet = resp.raw.read(_ERROR_BODY_MAX_BYTES, decode_content=True)
+            except Exception:
+                snippet = b""
+            resp.close()
+            try:
+                resp.raise_for_status()
+            except req_exc.HTTPError as exc:
+                exc.body_snippet = snippet
                 raise
-            sleep_s = backoff * (2 ** (attempt - 1))
-            logging.warning(
-                "Falha transitoria no POST Twilio (%s) tentativa %d/%d sleep=%.2fs",
-                type(exc).__name__,
-                attempt,
-                attempts,
-                sleep_s,
-            )
-            time.sleep(sleep_s)
-    if last_exc:
-        raise last_exc
+    # Sucesso ou erro JSON do Twilio (~1-2KB): .content le o corpo inteiro e
+    # devolve a conexao ao pool; no erro, e.response.json() continua valendo.
+    resp.content
+    resp.raise_for_status()
+    return resp
+
+
+def _make_poster(session, auth, timeout, retry, breaker, bucket=None):
+    """Retorna post(url, data) com sessao, auth e retry ja fixados.
+
+    Montado uma vez por envio em _get_poster, para que cada tentativa passe so
+    os argumentos que variam.
+    """
+    attempts, backoff, max_delay = retry
+    threshold, cooldown = breaker
+
+    def post(url, data):
+        if time.monotonic() < _BREAKER["open_until"]:
+            raise req_exc.ConnectionError("circuit open: envios Twilio suspensos temporariamente")
+
+        last_exc = None
+        sleep_s = backoff
+        for attempt in range(1, attempts + 1):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                resp = _session_post(session, url, data=data, auth=auth, timeout=timeout)
+                _breaker_record_success()
+                return resp
+            except req_exc.RequestException as exc:
+                last_exc = exc
+                # Criar mensagem no Twilio nao e idempotente: apos um timeout de
+                # leitura ela pode ja ter sido criada, e repetir o POST pode
+                # entregar o texto duas vezes. Aceito em troca de nao perder a
+                # resposta; as tentativas sao poucas e TWILIO_POST_RETRY_ATTEMPTS=1
+                # desliga o retry. 5xx nao e repetido.
+                transient = _is_transient_post_error(exc)
+                if not transient or attempt >= attempts or not _is_retryable_post_error(exc):
+                    if transient:
+                        _breaker_record_failure(threshold, cooldown)
+                    raise
+                # Decorrelated jitter: cada espera sorteia entre o backoff base e
+                # 3x a anterior, para os workers nao repetirem em sincronia
+                # durante uma falha correlacionada (rate limit, DNS, outage).
+                sleep_s = min(max_delay, random.uniform(backoff, sleep_s * 3))
+                # Retry-After vem do servidor: respeitado, mas nunca acima de max_delay para
+                # um 429 nao prender o worker pelo tempo que o servidor quiser.
+                sleep_s = max(sleep_s, min(max_delay, _retry_after_seconds(exc)))
+                logging.warning(
+                    "Falha transitoria no POST Twilio (%s) tentativa %d/%d sleep=%.2fs",
+                    type(exc).__name__,
+                    attempt,
+                    attempts,
+                    sleep_s,
+                )
+                time.sleep(sleep_s)
+        if last_exc:
+            raise last_exc
+
+    return post
+
+
+def _log_error_response(exc: Exception):
+    # Decodifica o corpo so se ERROR estiver habilitado.
+    if not logging.getLogger().isEnabledFor(logging.ERROR):
+        return
+    snippet = getattr(exc, "body_snippet", None)
+    if snippet is not None:
+        logging.error("Response: %s", snippet.decode("utf-8", "replace")[:_ERROR_LOG_MAX_CHARS])
+        return
+    response = getattr(exc, "response", None)
+    if response is not None:
+        logging.error("Response: %s", response.text[:_ERROR_LOG_MAX_CHARS])
+
+
+def _wa(number: str) -> str:
+    return number if number[:9] == "whatsapp:" else "whatsapp:" + number
+
+
+def _check_text_sender(cfg, messaging_service_sid):
+    if not cfg.has_credentials:
+        logging.error("Sem credenciais Twilio REST; não dá para enviar via API.")
+        return "missing_credentials"
+    if not (messaging_service_sid or cfg.from_number):
+        logging.error("Sem MessagingServiceSid e sem TWILIO_FROM; não dá para enviar via API.")
+        return "missing_sender"
+    return None
+
+
+def _sender_field(cfg, messaging_service_sid) -> tuple[str, str]:
+    if messaging_service_sid:
+        return ("MessagingServiceSid", messaging_service_sid)
+    return ("From", cfg.from_number)
+
+
+def _get_poster(cfg, settings, session, timeout=30):
+    # Montar o closure e barato; retry, breaker e bucket ja vem de lru_caches
+    # sobre os valores atuais da config.
+    return _make_poster(
+        session,
+        cfg.auth,
+        timeout,
+        _get_retry_settings(settings),
+        _get_breaker_settings(settings),
+        _bucket(settings),
+    )
 
 
 def send_whatsapp_text(
@@ -58,46 +361,22 @@ def send_whatsapp_text(
     settings,
     http_session,
 ) -> bool:
-    account_sid = (settings.get("TWILIO_ACCOUNT_SID") or "").strip()
-    auth_token = (settings.get("TWILIO_AUTH_TOKEN_REST") or settings.get("AUTH_TOKEN") or "").strip()
-    from_number = (settings.get("TWILIO_FROM") or "").strip()
-
-    if not account_sid or not auth_token:
-        logging.error("Sem credenciais Twilio REST; não dá para enviar via API.")
-        return False
-    if not (messaging_service_sid or from_number):
-        logging.error("Sem MessagingServiceSid e sem TWILIO_FROM; não dá para enviar via API.")
+    cfg = _twilio_config(settings)
+    if _check_text_sender(cfg, messaging_service_sid):
         return False
 
-    to = to_whatsapp if to_whatsapp.startswith("whatsapp:") else f"whatsapp:{to_whatsapp}"
-    url = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
-    data = {"To": to, "Body": body}
-    if messaging_service_sid:
-        data["MessagingServiceSid"] = messaging_service_sid
-    else:
-        data["From"] = from_number
-
-    session = http_session or requests.Session()
-    attempts, backoff = _get_retry_settings(settings)
-
+    to = _wa(to_whatsapp)
+    # Lista de pares em ordem fixa: requests codifica igual a um dict.
+    data = [("To", to), ("Body", body), _sender_field(cfg, messaging_service_sid)]
+    poster = _get_poster(cfg, settings, http_session or _get_default_session())
     try:
-        resp = _post_with_retry(
-            session=session,
-            url=url,
-            data=data,
-            auth=(account_sid, auth_token),
-            timeout=30,
-            attempts=attempts,
-            backoff=backoff,
-        )
-        sid = resp.json().get("sid")
-        logging.info(f"Enviado via REST: SID={sid} para {to}")
-        return True
+        resp = poster(cfg.url, data)
     except req_exc.RequestException as exc:
-        logging.error(f"Falha no envio REST: {exc}")
-        if hasattr(exc, "response") and exc.response is not None:
-            logging.error(f"Response: {exc.response.text}")
+        logging.error("Falha no envio REST: %s", exc)
+        _log_error_response(exc)
         return False
+    logging.info("Enviado via REST: SID=%s para %s", _response_sid(resp), to)
+    return True
 
 
 def send_twilio_template(
@@ -109,50 +388,34 @@ def send_twilio_template(
     settings,
     http_session,
 ):
-    account_sid = (settings.get("TWILIO_ACCOUNT_SID") or "").strip()
-    auth_token = (settings.get("TWILIO_AUTH_TOKEN_REST") or settings.get("AUTH_TOKEN") or "").strip()
-    from_number = (settings.get("TWILIO_FROM") or "").strip()
+    cfg = _twilio_config(settings)
 
-    if not account_sid or not auth_token:
+    if not cfg.has_credentials:
         logging.error("Credenciais Twilio REST não configuradas")
         raise ValueError("TWILIO_ACCOUNT_SID e TWILIO_AUTH_TOKEN_REST são obrigatórios")
 
-    url = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
     vars_dict = vars_dict or {}
     user_name = vars_dict.get("user_name") or vars_dict.get("1") or "cliente"
-    content_vars = {"user_name": user_name, "1": user_name}
-    data = {
-        "To": f"whatsapp:{to_e164_plus}" if not to_e164_plus.startswith("whatsapp:") else to_e164_plus,
-        "ContentSid": content_sid,
-        "ContentVariables": json.dumps(content_vars, ensure_ascii=False),
-    }
-    if messaging_service_sid:
-        data["MessagingServiceSid"] = messaging_service_sid
-    elif from_number:
-        data["From"] = from_number
-    else:
+    content_vars = _encode_content_vars(user_name)
+    if not (messaging_service_sid or cfg.from_number):
         logging.error("Nem MessagingServiceSid nem TWILIO_FROM configurados")
         raise ValueError("Configure TWILIO_WHATSAPP_FROM ou passe messaging_service_sid")
+    data = [
+        ("To", _wa(to_e164_plus)),
+        ("ContentSid", content_sid),
+        ("ContentVariables", content_vars),
+        _sender_field(cfg, messaging_service_sid),
+    ]
 
-    logging.info(f"Enviando template {content_sid} para {to_e164_plus} com vars: {content_vars}")
+    logging.info("Enviando template %s para %s com vars: %s", content_sid, to_e164_plus, content_vars)
 
-    session = http_session or requests.Session()
-    attempts, backoff = _get_retry_settings(settings)
+    poster = _get_poster(cfg, settings, http_session or _get_default_session(), timeout=20)
 
     try:
-        resp = _post_with_retry(
-            session=session,
-            url=url,
-            data=data,
-            auth=(account_sid, auth_token),
-            timeout=20,
-            attempts=attempts,
-            backoff=backoff,
-        )
-        logging.info(f"Template enviado com sucesso: SID={resp.json().get('sid')}")
+        resp = poster(cfg.url, data)
+        logging.info("Template enviado com sucesso: SID=%s", _response_sid(resp))
         return resp
     except req_exc.RequestException as exc:
-        logging.error(f"Erro ao enviar template: {exc}")
-        if hasattr(exc, "response") and exc.response is not None:
-            logging.error(f"Response: {exc.response.text}")
+        logging.error("Erro ao enviar template: %s", exc)
+        _log_error_response(exc)
         raise
@@ -1,10 +1,16 @@
-﻿import logging
+﻿import atexit
+import functools
+import heapq
+import itertools
+import logging
 import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Response
-from twilio.request_validator import RequestValidator
+from google.api_core import exceptions as gexc
 from google.cloud import firestore
 
 from app.core.logging import log_event
@@ -12,31 +18,73 @@ from app.services.cx_service import cx_all_params_dict, detect_intent_text
 from app.services.transcription_service import is_audio_media_type, transcribe_twilio_audio
 from app.services.twilio_service import send_whatsapp_text
 
+logger = logging.getLogger(__name__)
 
-def twiml_empty(status: int = 200) -> Response:
-    twiml = """<?xml version="1.0" encoding="UTF-8"?>
-<Response></Response>"""
-    resp = Response(twiml, status=status, mimetype="text/xml; charset=utf-8")
-    resp.headers["Cache-Control"] = "no-store"
-    return resp
+
+_TWIML_EMPTY_BODY = b'<?xml version="1.0" encoding="UTF-8"?>\n<Response></Response>'
+_TWIML_HEADERS = {"Cache-Control": "no-store"}
 
 
-_message_buffers = {}
-_buffers_lock = threading.Lock()
+def twiml_empty(status: int = 200) -> Response:
+    return Response(_TWIML_EMPTY_BODY, status=status, content_type="text/xml; charset=utf-8", headers=_TWIML_HEADERS)
+
+
+# Buffers particionados por conversa: webhooks de numeros diferentes nao
+# disputam o mesmo lock.
+_SHARDS = 32
+_shards = [({}, threading.Lock()) for _ in range(_SHARDS)]
+
+# Agendador unico dos debounces: heap de (deadline, conversation_id, gen).
+# Reagendar so empilha uma nova entrada; entradas com gen antigo sao ignoradas.
+_sched_heap = []
+_sched_cv = threading.Condition()
+_sched_thread = None
+# gen global (next() em itertools.count e atomico): entradas de um buffer ja
+# descartado nunca casam com um buffer novo da mesma conversa.
+_gen_counter = itertools.count(1)
+
+# Pool unico para o processamento em background (CX + envio). Criado no
+# primeiro uso, para existir em cada worker apos o fork.
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
 FALLBACK_STABILITY_TEXT = "Tivemos um problema de estabilidade, pode repetir sua pergunta?"
 FALLBACK_EMPTY_REPLY_TEXT = "Nao consegui gerar uma resposta agora, pode repetir sua pergunta?"
 
 
+# O SDK do Twilio e importado no primeiro uso, fora do caminho de cold start
+# (import do modulo / primeira requisicao do Cloud Run).
+@functools.lru_cache(maxsize=4)
+def _get_validator(auth_token: str):
+    from twilio.request_validator import RequestValidator
+
+    return RequestValidator(auth_token)
+
+
+def _signature_matches(validator, url: str, params, signature: str) -> bool:
+    # Mesmo criterio do RequestValidator.validate (URL sem e com porta), mas
+    # para no primeiro acerto em vez de calcular sempre os dois HMACs.
+    from urllib.parse import urlparse
+
+    from twilio.request_validator import add_port, compare, remove_port
+
+    parsed = urlparse(url)
+    for uri in (remove_port(parsed), add_port(parsed)):
+        if compare(validator.compute_signature(uri, params), signature):
+            return True
+    return False
+
+
 def is_valid_twilio_request(req, auth_token: str) -> bool:
     if not auth_token:
         return True
     signature = req.headers.get("X-Twilio-Signature", "")
-    params = req.form.to_dict(flat=True)
-    validator = RequestValidator(auth_token)
+    validator = _get_validator(auth_token)
     try:
-        ok = validator.validate(req.url, params, signature)
+        # Sem assinatura nao ha o que comparar: rejeita sem calcular HMAC.
+        # O validator le MultiDict via getall(): passa req.form sem copiar.
+        ok = bool(signature) and _signature_matches(validator, req.url, req.form, signature)
         if not ok:
-            logging.warning(
+            logger.warning(
                 "Assinatura inválida: url=%s proto=%s host=%s",
                 req.url,
                 req.headers.get("X-Forwarded-Proto"),
@@ -47,56 +95,114 @@ def is_valid_twilio_request(req, auth_token: str) -> bool:
         return False
 
 
+# Os ids sao deterministicos por numero; so o fallback com uuid fica fora do cache.
+@functools.lru_cache(maxsize=8192)
+def _digits_from_from_field(from_field: str) -> str:
+    return from_field.replace("whatsapp:", "").replace("+", "").strip()
+
+
+@functools.lru_cache(maxsize=8192)
+def _e164_from_from_field(from_field: str) -> str:
+    sid = _digits_from_from_field(from_field)
+    return f"+{sid}" if sid else ""
+
+
 def _session_id_from_from_field(from_field: str) -> str:
     if not from_field:
         return str(uuid.uuid4())
-    sid = from_field.replace("whatsapp:", "").replace("+", "").strip()
-    return sid or str(uuid.uuid4())
+    return _digits_from_from_field(from_field) or str(uuid.uuid4())
 
 
 def _conversation_id_e164(from_field: str) -> str:
-    sid = _session_id_from_from_field(from_field)
-    return f"+{sid}" if sid and not sid.startswith("+") else sid
+    return (from_field and _e164_from_from_field(from_field)) or f"+{uuid.uuid4()}"
+
+
+# Status em que a conversa esta (ou vai para) um atendente humano.
+_HANDOFF_STATUSES = frozenset(("pending_handoff", "claimed", "active"))
+_MISSING = object()
+
+
+def _is_true_str(value: str) -> bool:
+    # So "true" conta como verdadeiro, igual a _bool_env em config.py. Com 4
+    # caracteres nao ha o que tirar com strip().
+    if len(value) == 4:
+        return value[0] in "tT" and value.lower() == "true"
+    return value.strip().lower() == "true"
 
 
 def _is_truthy(value) -> bool:
+    kind = type(value)
+    if kind is bool:
+        return value
+    if kind is str:
+        return _is_true_str(value)
     if value is None:
         return False
-    if isinstance(value, bool):
-        return value
+    if kind is dict:
+        return any(_is_truthy(v) for v in value.values())
+    # Subclasses (ex.: OrderedDict) caem no caminho generico.
     if isinstance(value, str):
-        return value.strip().lower() == "true"
+        return _is_true_str(value)
     if isinstance(value, dict):
-        for v in value.values():
-            if _is_truthy(v):
-                return True
+        return any(_is_truthy(v) for v in value.values())
     return False
 
 
 def _bool_setting(settings, key, default=False) -> bool:
-    if key not in settings:
-        return default
-    return _is_truthy(settings.get(key))
+    # Memoiza no proprio objeto de config, guardando o valor cru junto: se a
+    # chave for alterada depois, o valor novo nao e o mesmo objeto e o
+    # resultado e recalculado. dict puro nao aceita atributos e recalcula sempre.
+    raw = settings.get(key, _MISSING)
+    cache = getattr(settings, "_bool_setting_cache", None)
+    if cache is None:
+        cache = {}
+        try:
+            settings._bool_setting_cache = cache
+        except AttributeError:
+            cache = None
+    else:
+        hit = cache.get((key, default))
+        if hit is not None and hit[0] is raw:
+            return hit[1]
+
+    result = default if raw is _MISSING else _is_truthy(raw)
+    if cache is not None:
+        cache[(key, default)] = (raw, result)
+    return result
+
+
+def _bot_muted_by_handoff(conv_data: dict, settings) -> bool:
+    status = (conv_data.get("status") or "bot").lower()
+    if status not in _HANDOFF_STATUSES and not conv_data.get("handoff_active"):
+        return False
+    return not (settings.get("FEATURE_DISABLE_HANDOFF") and settings.get("FEATURE_FORCE_BOT_WHEN_HANDOFF_DISABLED"))
 
 
 def _normalize_for_exact_match(text: str) -> str:
-    return " ".join((text or "").split()).casefold()
+    text = " ".join((text or "").split())
+    # Para ASCII, lower() e equivalente a casefold() e evita as tabelas Unicode.
+    return text.lower() if text.isascii() else text.casefold()
 
 
-def _handoff_from_cx(resp, texts, allow_param: bool, settings) -> bool:
+@functools.lru_cache(maxsize=8)
+def _normalized_hint_set(hints: tuple) -> frozenset:
+    # Matching de hints e exato (apos normalizacao): o frozenset resolve cada
+    # texto do CX com um lookup. Chave e a tupla atual da config.
+    return frozenset(_normalize_for_exact_match(hint) for hint in hints if hint)
+
+
+def _handoff_from_cx(params_dict: dict, texts, allow_param: bool, settings) -> bool:
     try:
+        hints = _normalized_hint_set(tuple(settings.get("DF_HANDOFF_TEXT_HINTS", ())))
         for text in texts or []:
-            text_norm = _normalize_for_exact_match(text)
-            for hint in settings.get("DF_HANDOFF_TEXT_HINTS", []):
-                if hint and text_norm == hint:
-                    logging.info("Handoff detectado via hint exato.")
-                    return True
+            if _normalize_for_exact_match(text) in hints:
+                logger.info("Handoff detectado via hint exato.")
+                return True
 
         if allow_param:
-            sp_dict = cx_all_params_dict(resp)
             key = settings.get("DF_HANDOFF_PARAM")
-            if key and _is_truthy(sp_dict.get(key)):
-                logging.info("Handoff detectado via parametro %s: %s", key, sp_dict.get(key))
+            if key and _is_truthy(params_dict.get(key)):
+                logger.info("Handoff detectado via parametro %s: %s", key, params_dict.get(key))
                 return True
 
     except Exception:
@@ -105,48 +211,69 @@ def _handoff_from_cx(resp, texts, allow_param: bool, settings) -> bool:
 
 
 def _join_bot_texts(texts):
-    try:
-        parts = []
-        last_norm = None
-        for raw_text in texts or []:
-            if not isinstance(raw_text, str):
-                continue
-            text = raw_text.strip()
-            if not text:
-                continue
+    if not texts:
+        return ""
+    if len(texts) == 1:
+        # Caso comum: uma unica resposta do CX, sem lista nem join.
+        text = texts[0]
+        return text.strip() if isinstance(text, str) else ""
 
-            # Evita repetir a mesma mensagem quando o CX devolve peças duplicadas
-            # consecutivas no mesmo response_messages.
-            text_norm = _normalize_for_exact_match(text)
-            if last_norm is not None and text_norm == last_norm:
-                continue
+    parts = []
+    last_norm = None
+    for raw_text in texts:
+        if not isinstance(raw_text, str):
+            continue
+        text = raw_text.strip()
+        if not text:
+            continue
 
-            parts.append(text)
-            last_norm = text_norm
+        # Evita repetir a mesma mensagem quando o CX devolve peças duplicadas
+        # consecutivas no mesmo response_messages.
+        text_norm = _normalize_for_exact_match(text)
+        if last_norm is not None and text_norm == last_norm:
+            continue
 
-        return "\n\n".join(parts)
-    except Exception:
-        return ""
+        parts.append(text)
+        last_norm = text_norm
+
+    return "\n\n".join(parts)
 
 
 def _merge_audio_transcript(body: str, transcript: str) -> str:
-    if "[Audio]" in (body or ""):
-        return body.replace("[Audio]", transcript)
-    if (body or "").strip():
+    if not body:
+        return transcript
+    # split faz uma unica varredura e ja diz se havia placeholder.
+    parts = body.split("[Audio]")
+    if len(parts) > 1:
+        return transcript.join(parts)
+    if body.strip():
         return f"{body}\n\n[Transcricao de audio] {transcript}"
     return transcript
 
 
+# Placeholder do body para midia sem legenda; o que nao casar vira documento.
+_MEDIA_PREFIX_PLACEHOLDER = (("image/", "[Imagem]"), ("video/", "[Video]"))
+
+
+def _media_placeholder(media_type: str) -> str:
+    if is_audio_media_type(media_type):
+        return "[Audio]"
+    return next((text for prefix, text in _MEDIA_PREFIX_PLACEHOLDER if media_type.startswith(prefix)), "[Documento]")
+
+
 def extract_inbound_request(req):
-    frm = req.form.get("From", "")
-    to = req.form.get("To", "")
-    body = req.form.get("Body", "") or ""
-    sid = req.form.get("MessageSid")
-    profile_name = (req.form.get("ProfileName") or "").strip()
-    wa_id = (req.form.get("WaId") or "").strip()
+    # MultiDict do werkzeug ja e um dict: .get e O(1), copiar nao ajuda.
+    form = req.form
+    frm = form.get("From", "")
+    to = form.get("To", "")
+    body = form.get("Body", "") or ""
+    body_stripped = body.strip()
+    sid = form.get("MessageSid")
+    profile_name = (form.get("ProfileName") or "").strip()
+    wa_id = (form.get("WaId") or "").strip()
 
     try:
-        num_media = int(req.form.get("NumMedia", 0))
+        num_media = int(form.get("NumMedia", 0))
     except (TypeError, ValueError):
         num_media = 0
 
@@ -154,17 +281,11 @@ def extract_inbound_request(req):
     media_type = None
 
     if num_media > 0:
-        media_url = req.form.get("MediaUrl0")
-        media_type = req.form.get("MediaContentType0")
-
-        if is_audio_media_type(media_type) and not body.strip():
-            body = "[Audio]"
-        elif media_type and media_type.startswith("image/") and not body.strip():
-            body = "[Imagem]"
-        elif media_type and media_type.startswith("video/") and not body.strip():
-            body = "[Video]"
-        elif media_type and not body.strip():
-            body = "[Documento]"
+        media_url = form.get("MediaUrl0")
+        media_type = form.get("MediaContentType0")
+
+        if media_type and not body_stripped:
+            body = body_stripped = _media_placeholder(media_type)
 
     conversation_id = _conversation_id_e164(frm)
     session_id = _session_id_from_from_field(frm)
@@ -173,6 +294,9 @@ def extract_inbound_request(req):
         "from": frm,
         "to": to,
         "body": body,
+        # Calculados uma vez aqui; handle_webhook e o buffer reaproveitam nos logs.
+        "body_stripped": body_stripped,
+        "body_preview": body[:50],
         "sid": sid,
         "profile_name": profile_name,
         "wa_id": wa_id,
@@ -183,70 +307,187 @@ def extract_inbound_request(req):
     }
 
 
-def _get_or_create_buffer(conversation_id: str) -> dict:
-    with _buffers_lock:
-        if conversation_id not in _message_buffers:
-            _message_buffers[conversation_id] = {
-                "messages": [],
-                "timer": None,
-                "lock": threading.Lock(),
-                "first_ts": None,
-                "first_data": None,
-            }
-        return _message_buffers[conversation_id]
+class _Buffer:
+    """Mensagens pendentes de uma conversa ate o fim do debounce.
+
+    Sem lock proprio: produtores so fazem deque.append e atribuicoes simples,
+    e o buffer so e fechado e drenado por _drain_buffer.
+    first_ts/first_data/debounce sao fixados na criacao, sob o lock do shard,
+    e nunca escritos pelos produtores.
+    """
+
+    __slots__ = ("messages", "gen", "deadline", "closed", "first_ts", "first_data", "debounce")
+
+    def __init__(self, first_ts: float, first_data: dict, debounce: tuple[float, float, float]):
+        self.messages = deque()
+        self.gen = 0
+        self.deadline = None
+        self.closed = False
+        self.first_ts = first_ts
+        self.first_data = first_data
+        self.debounce = debounce
 
 
-def _clear_buffer(conversation_id: str):
-    with _buffers_lock:
-        buffer = _message_buffers.pop(conversation_id, None)
-        if buffer and buffer.get("timer"):
+def _shard(conversation_id: str):
+    return _shards[hash(conversation_id) & (_SHARDS - 1)]
+
+
+def _get_buffer(conversation_id: str):
+    return _shard(conversation_id)[0].get(conversation_id)
+
+
+def _get_or_create_buffer(conversation_id: str, settings, now: float, first_data: dict) -> _Buffer:
+    buffers, lock = _shard(conversation_id)
+    with lock:
+        buffer = buffers.get(conversation_id)
+        if buffer is None:
+            # Settings lidos so por quem cria o buffer; as mensagens seguintes
+            # usam o deadline pronto.
+            buffer = buffers[conversation_id] = _Buffer(now, first_data, _debounce_params(settings, now))
+        return buffer
+
+
+def _clear_buffer(conversation_id: str, buffer: _Buffer = None):
+    buffers, lock = _shard(conversation_id)
+    with lock:
+        if buffer is None or buffers.get(conversation_id) is buffer:
+            buffers.pop(conversation_id, None)
+
+
+def _get_worker_pool(settings=None) -> ThreadPoolExecutor:
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                try:
+                    workers = int((settings or {}).get("WEBHOOK_WORKERS", 32))
+                except (TypeError, ValueError):
+                    workers = 32
+                _worker_pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="webhook")
+    return _worker_pool
+
+
+def _scheduler_loop():
+    while True:
+        with _sched_cv:
+            while True:
+                if not _sched_heap:
+                    _sched_cv.wait()
+                    continue
+                wait = _sched_heap[0][0] - time.monotonic()
+                if wait <= 0:
+                    break
+                _sched_cv.wait(wait)
+            _deadline, conversation_id, gen = heapq.heappop(_sched_heap)
+
+        buffer = _get_buffer(conversation_id)
+        if buffer is None or buffer.gen != gen:
+            continue
+        pending = _drain_buffer(conversation_id, buffer)
+        if pending is None:
+            continue
+
+        first_data = buffer.first_data or {}
+        try:
+            _get_worker_pool(first_data.get("settings")).submit(
+                _process_aggregated_messages, conversation_id, first_data, pending
+            )
+        except RuntimeError:
+            # Interpretador encerrando (pool ja finalizado): processa aqui mesmo.
+            _process_aggregated_messages(conversation_id, first_data, pending)
+
+
+def _drain_buffer(conversation_id: str, buffer: _Buffer):
+    """Fecha o buffer e retorna suas mensagens; None se outro consumidor ja fechou."""
+    buffers, lock = _shard(conversation_id)
+    with lock:
+        # Agendador e flush de saida podem disputar o mesmo buffer: so um fecha.
+        if buffer.closed or buffers.get(conversation_id) is not buffer:
+            return None
+        # Fecha antes de trocar a fila, assim um produtor que ainda estava no
+        # append percebe e reenvia a mensagem para um buffer novo.
+        buffer.closed = True
+    buffer.deadline = None
+    pending, buffer.messages = buffer.messages, deque()
+    _clear_buffer(conversation_id, buffer)
+    return pending
+
+
+def _flush_buffers():
+    # atexit roda depois que o interpretador ja finalizou o pool de workers:
+    # conversas ainda no debounce sao respondidas aqui em vez de perdidas.
+    for buffers, lock in _shards:
+        with lock:
+            items = list(buffers.items())
+        for conversation_id, buffer in items:
+            pending = _drain_buffer(conversation_id, buffer)
+            if not pending:
+                continue
+            logger.warning("Encerrando: processando buffer de %s (%d mensagens)", conversation_id, len(pending))
             try:
-                buffer["timer"].cancel()
+                _process_aggregated_messages(conversation_id, buffer.first_data or {}, pending)
             except Exception:
-                pass
+                logger.exception("Falha ao processar buffer de %s no encerramento", conversation_id)
 
 
-def _calculate_next_delay(buffer: dict, settings) -> float:
-    now = time.time()
-    first_ts = buffer.get("first_ts") or now
-    elapsed = now - first_ts
+atexit.register(_flush_buffers)
+
 
+def _schedule_buffer(conversation_id: str, deadline: float, gen: int):
+    global _sched_thread
+    with _sched_cv:
+        # Iniciada no primeiro uso (e nao no import) para sobreviver ao fork dos workers.
+        if _sched_thread is None or not _sched_thread.is_alive():
+            _sched_thread = threading.Thread(target=_scheduler_loop, name="aggregation-scheduler", daemon=True)
+            _sched_thread.start()
+        heapq.heappush(_sched_heap, (deadline, conversation_id, gen))
+        _sched_cv.notify()
+
+
+def _debounce_params(settings, first_ts: float) -> tuple[float, float, float]:
     initial_seconds = float(settings.get("MESSAGE_DEBOUNCE_INITIAL_SECONDS", 5.0))
     extend_seconds = float(settings.get("MESSAGE_DEBOUNCE_EXTEND_SECONDS", 3.0))
     max_seconds = float(settings.get("MESSAGE_DEBOUNCE_MAX_SECONDS", 10.0))
+    return initial_seconds, extend_seconds, first_ts + max_seconds
 
-    remaining_to_max = max_seconds - elapsed
+
+def _calculate_next_delay(buffer: _Buffer) -> float:
+    initial_seconds, extend_seconds, hard_deadline = buffer.debounce
+    remaining_to_max = hard_deadline - time.time()
     if remaining_to_max <= 0:
         return 0.1
 
-    if len(buffer.get("messages", [])) <= 1:
+    if len(buffer.messages) <= 1:
         return min(initial_seconds, remaining_to_max)
 
     return min(extend_seconds, remaining_to_max)
 
 
-def _process_aggregated_messages(conversation_id: str):
-    buffer = _message_buffers.get(conversation_id)
-    if not buffer:
-        logging.warning("Buffer nao encontrado para %s no momento do processamento", conversation_id)
-        return
-
-    with buffer["lock"]:
-        messages = list(buffer.get("messages", []))
-        first_data = buffer.get("first_data")
-
-        if not messages or not first_data:
-            logging.info("Buffer vazio ou sem dados para %s, ignorando", conversation_id)
-            _clear_buffer(conversation_id)
-            return
-
-        buffer["timer"] = None
+def _process_aggregated_messages(conversation_id: str, first_data: dict, pending: deque):
+    # Drena a fila numa passada so, ja separando textos e a primeira midia.
+    message_count = 0
+    message_bodies = []
+    media_url = media_type = media_message_id = None
+    while True:
+        try:
+            msg = pending.popleft()
+        except IndexError:
+            break
+        message_count += 1
+        text = msg.get("body")
+        if text:
+            message_bodies.append(text)
+        if media_url is None and msg.get("media_url"):
+            media_url = msg["media_url"]
+            media_type = msg.get("media_type")
+            media_message_id = msg.get("inbound_id")
 
-    _clear_buffer(conversation_id)
+    if not message_count or not first_data:
+        logger.info("Buffer vazio ou sem dados para %s, ignorando", conversation_id)
+        return
 
-    message_bodies = [m.get("body", "").strip() for m in messages if m.get("body", "").strip()]
     if not message_bodies:
-        logging.info("Nenhum corpo de mensagem valido para %s", conversation_id)
+        logger.info("Nenhum corpo de mensagem valido para %s", conversation_id)
         return
 
     if len(message_bodies) == 1:
@@ -264,28 +505,19 @@ def _process_aggregated_messages(conversation_id: str):
     http_session = first_data.get("http_session")
     speech_client = first_data.get("speech_client")
 
-    media_url = None
-    media_type = None
-    media_message_id = None
-    for msg in messages:
-        if msg.get("media_url"):
-            media_url = msg["media_url"]
-            media_type = msg.get("media_type")
-            media_message_id = msg.get("inbound_id")
-            break
-
-    aggregated_id = f"agg:{inbound_id}:{len(messages)}"
+    aggregated_id = f"agg:{inbound_id}:{message_count}"
 
-    logging.info(
-        "Processando %d mensagens agregadas para %s: %r",
-        len(messages),
-        conversation_id,
-        aggregated_body[:100],
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Processando %d mensagens agregadas para %s: %r",
+            message_count,
+            conversation_id,
+            aggregated_body[:100],
+        )
     log_event(
         "aggregated_messages",
         conversation_id=conversation_id,
-        message_count=len(messages),
+        message_count=message_count,
         aggregated_text=aggregated_body[:200],
     )
 
@@ -322,69 +554,83 @@ def _add_to_aggregation_buffer(
     cx_client,
     http_session,
     speech_client=None,
+    body_stripped: str = None,
+    body_preview: str = None,
 ):
     if not _bool_setting(settings, "FEATURE_MESSAGE_AGGREGATION", default=True):
         return False
 
-    buffer = _get_or_create_buffer(conversation_id)
-
-    with buffer["lock"]:
-        now = time.time()
-        if not buffer["messages"]:
-            buffer["first_ts"] = now
-            buffer["first_data"] = {
-                "frm": frm,
-                "session_id": session_id,
-                "conv_data": conv_data,
-                "inbound_id": inbound_id,
-                "settings": settings,
-                "repo": repo,
-                "cx_client": cx_client,
-                "http_session": http_session,
-                "speech_client": speech_client,
-            }
-
-        buffer["messages"].append({
-            "body": body,
-            "inbound_id": inbound_id,
-            "media_url": media_url,
-            "media_type": media_type,
-            "ts": now,
-        })
-
-        if buffer.get("timer"):
-            try:
-                buffer["timer"].cancel()
-            except Exception:
-                pass
+    if body_stripped is None:
+        body_stripped = (body or "").strip()
+    if body_preview is None:
+        body_preview = body[:50] if body else ""
 
-        delay = _calculate_next_delay(buffer, settings)
+    now = time.time()
+    item = {
+        # Ja sem espacos nas pontas: o dreno so filtra vazios.
+        "body": body_stripped,
+        "inbound_id": inbound_id,
+        "media_url": media_url,
+        "media_type": media_type,
+        "ts": now,
+    }
+    first_data = {
+        "frm": frm,
+        "session_id": session_id,
+        "conv_data": conv_data,
+        "inbound_id": inbound_id,
+        "settings": settings,
+        "repo": repo,
+        "cx_client": cx_client,
+        "http_session": http_session,
+        "speech_client": speech_client,
+    }
 
-        logging.info(
-            "Mensagem %d adicionada ao buffer de %s. Delay: %.1fs. Texto: %r",
-            len(buffer["messages"]),
-            conversation_id,
-            delay,
-            body[:50] if body else "",
-        )
+    while True:
+        buffer = _get_or_create_buffer(conversation_id, settings, now, first_data)
+        # deque.append e atomico; guarda a fila usada para o caso de o
+        # agendador troca-la logo em seguida.
+        pending = buffer.messages
+        pending.append(item)
 
-        timer = threading.Timer(delay, _process_aggregated_messages, args=(conversation_id,))
-        timer.daemon = True
-        buffer["timer"] = timer
-        timer.start()
+        if not buffer.closed:
+            delay = _calculate_next_delay(buffer)
 
-    return True
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Mensagem %d adicionada ao buffer de %s. Delay: %.1fs. Texto: %r",
+                    len(pending),
+                    conversation_id,
+                    delay,
+                    body_preview,
+                )
+
+            gen = next(_gen_counter)
+            buffer.gen = gen
+            buffer.deadline = time.monotonic() + delay
+            _schedule_buffer(conversation_id, buffer.deadline, gen)
+            return True
+
+        # Buffer fechado durante o append: se a mensagem ainda esta na fila,
+        # ninguem vai drena-la e ela vai para um buffer novo; se ja saiu, esta
+        # sendo processada.
+        try:
+            pending.remove(item)
+        except ValueError:
+            return True
+        _clear_buffer(conversation_id, buffer)
 
 
 def get_aggregation_debug_info(settings):
-    with _buffers_lock:
-        info = {}
-        for conv_id, buf in _message_buffers.items():
-            info[conv_id] = {
-                "message_count": len(buf.get("messages", [])),
-                "first_ts": buf.get("first_ts"),
-                "has_timer": buf.get("timer") is not None,
-            }
+    info = {}
+    for buffers, lock in _shards:
+        with lock:
+            for conv_id, buf in buffers.items():
+                info[conv_id] = {
+                    "message_count": len(buf.messages),
+                    "first_ts": buf.first_ts,
+                    "has_timer": buf.deadline is not None,
+                }
 
     return {
         "aggregation_enabled": _bool_setting(settings, "FEATURE_MESSAGE_AGGREGATION", default=True),
@@ -399,7 +645,7 @@ def get_aggregation_debug_info(settings):
 
 def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_client=None):
     if not is_valid_twilio_request(req, settings.get("AUTH_TOKEN")):
-        logging.warning("Twilio signature inválida para URL %s", req.url)
+        logger.warning("Twilio signature inválida para URL %s", req.url)
         return Response("Invalid signature", status=403)
 
     inbound = extract_inbound_request(req)
@@ -407,6 +653,7 @@ def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_clien
     frm = inbound["from"]
     to = inbound["to"]
     body = inbound["body"]
+    body_preview = inbound["body_preview"]
     sid = inbound["sid"]
     profile_name = inbound.get("profile_name") or ""
     media_type = inbound["media_type"]
@@ -414,7 +661,8 @@ def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_clien
     conversation_id = inbound["conversation_id"]
     session_id = inbound["session_id"]
 
-    logging.info("Inbound: from=%s sid=%s body=%r", frm, sid, body[:50] if body else "")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Inbound: from=%s sid=%s body=%r", frm, sid, body_preview)
     log_event(
         "inbound",
         conversation_id=conversation_id,
@@ -426,30 +674,11 @@ def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_clien
         wa_profile_name=profile_name or None,
     )
 
-    conv_snap, _existed = repo.ensure_conversation(conversation_id, session_id)
-    conv_data = conv_snap.to_dict() if conv_snap else {}
+    conv_data, _existed = repo.ensure_conversation(conversation_id, session_id)
 
     idem = req.headers.get("I-Twilio-Idempotency-Token")
     inbound_id = sid or idem or str(uuid.uuid4())
 
-    created = repo.add_message_if_new(
-        conversation_id,
-        inbound_id,
-        "in",
-        "user",
-        body,
-        media_url=media_url,
-        media_type=media_type,
-    )
-    if not created:
-        logging.info(
-            "Webhook duplicado (inbound ja existe). Ignorando processamento. inbound_id=%s sid=%s idem=%s",
-            inbound_id,
-            sid,
-            idem,
-        )
-        return twiml_empty(status=200)
-
     conv_updates = {
         "last_message_text": body,
         "last_in_from": "user",
@@ -458,12 +687,46 @@ def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_clien
     if profile_name:
         conv_updates["wa_profile_name"] = profile_name
 
-    repo.update_conversation(conversation_id, **conv_updates)
+    # Mensagem inbound + atualizacao da conversa em um unico commit. Se o
+    # inbound ja existe, o create() derruba o batch inteiro (AlreadyExists).
+    try:
+        with repo.batched() as batch:
+            repo.add_message_if_new(
+                conversation_id,
+                inbound_id,
+                "in",
+                "user",
+                body,
+                media_url=media_url,
+                media_type=media_type,
+                batch=batch,
+            )
+            repo.update_conversation(conversation_id, batch=batch, **conv_updates)
+    except gexc.AlreadyExists:
+        logger.info(
+            "Webhook duplicado (inbound ja existe). Ignorando processamento. inbound_id=%s sid=%s idem=%s",
+            inbound_id,
+            sid,
+            idem,
+        )
+        return twiml_empty(status=200)
+
+    # Conversa com atendente: o inbound ja foi salvo para o CRM e o bot nao
+    # responderia; evita buffer/thread so para descartar a mensagem depois.
+    if _bot_muted_by_handoff(conv_data, settings):
+        logger.info(
+            "Handoff mode (%s): sem resposta automática para %s",
+            conv_data.get("status"),
+            conversation_id,
+        )
+        return twiml_empty(status=200)
 
     added_to_buffer = _add_to_aggregation_buffer(
         conversation_id=conversation_id,
         frm=frm,
         body=body,
+        body_stripped=inbound["body_stripped"],
+        body_preview=body_preview,
         inbound_id=inbound_id,
         session_id=session_id,
         media_url=media_url,
@@ -477,35 +740,54 @@ def handle_webhook(req, *, settings, repo, cx_client, http_session, speech_clien
     )
 
     if not added_to_buffer:
-        thread = threading.Thread(
-            target=process_message_async,
-            args=(
-                frm,
-                body,
-                inbound_id,
-                conversation_id,
-                session_id,
-                media_url,
-                media_type,
-                conv_data,
-            ),
-            kwargs={
-                "settings": settings,
-                "repo": repo,
-                "cx_client": cx_client,
-                "http_session": http_session,
-                "speech_client": speech_client,
-                "source_message_id": inbound_id,
-            },
-            daemon=True,
+        _get_worker_pool(settings).submit(
+            process_message_async,
+            frm,
+            body,
+            inbound_id,
+            conversation_id,
+            session_id,
+            media_url,
+            media_type,
+            conv_data,
+            settings=settings,
+            repo=repo,
+            cx_client=cx_client,
+            http_session=http_session,
+            speech_client=speech_client,
+            source_message_id=inbound_id,
         )
-        thread.start()
-        logging.info("Respondendo ao Twilio imediatamente (processamento async iniciado - sem agregacao)")
+        logger.info("Respondendo ao Twilio imediatamente (processamento async iniciado - sem agregacao)")
     else:
-        logging.info("Respondendo ao Twilio imediatamente (mensagem adicionada ao buffer de agregacao)")
+        logger.info("Respondendo ao Twilio imediatamente (mensagem adicionada ao buffer de agregacao)")
     return twiml_empty(status=200)
 
 
+def _flush_conv_updates(repo, conversation_id: str, conv_updates: dict):
+    if not conv_updates:
+        return
+    try:
+        repo.update_conversation(conversation_id, **conv_updates)
+    except Exception:
+        logger.warning("Falha ao atualizar conversa %s", conversation_id, exc_info=True)
+
+
+def _commit_reply(repo, conversation_id: str, out_msg_id: str, reply_text: str, conv_updates: dict) -> bool:
+    """Grava a resposta do bot e as atualizacoes da conversa em um unico commit.
+
+    Retorna False se a resposta ja existia (as atualizacoes sao gravadas mesmo assim).
+    """
+    try:
+        with repo.batched() as batch:
+            repo.add_message_if_new(conversation_id, out_msg_id, "out", "bot", reply_text, batch=batch)
+            if conv_updates:
+                repo.update_conversation(conversation_id, batch=batch, **conv_updates)
+        return True
+    except gexc.AlreadyExists:
+        _flush_conv_updates(repo, conversation_id, conv_updates)
+        return False
+
+
 def process_message_async(
     frm: str,
     body: str,
@@ -524,7 +806,8 @@ def process_message_async(
     source_message_id: str | None = None,
 ):
     try:
-        logging.info("Processando async: %s - %s...", conversation_id, body[:50])
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Processando async: %s - %s...", conversation_id, body[:50])
 
         inbound_id = sid or session_id
         transcription_message_id = source_message_id or inbound_id
@@ -532,10 +815,15 @@ def process_message_async(
 
         status = (conv_data.get("status") or "bot").lower()
         handoff_active = bool(conv_data.get("handoff_active"))
-
-        if status in ("pending_handoff", "claimed", "active") or handoff_active:
-            if settings.get("FEATURE_DISABLE_HANDOFF") and settings.get("FEATURE_FORCE_BOT_WHEN_HANDOFF_DISABLED"):
-                logging.info(
+        # Mudancas de status e a transcricao sao gravadas na hora: novas mensagens
+        # ja as enxergam durante o CX, e uma falha no meio nao as perde. So o que
+        # vem da resposta do CX (session_parameters) vai junto com a resposta
+        # do bot (ver _commit_reply).
+        conv_updates = {}
+
+        if status in _HANDOFF_STATUSES or handoff_active:
+            if not _bot_muted_by_handoff(conv_data, settings):
+                logger.info(
                     "Handoff desabilitado: convertendo conversa (%s) para bot: %s",
                     status,
                     conversation_id,
@@ -550,14 +838,14 @@ def process_message_async(
                 status = "bot"
                 handoff_active = False
             else:
-                logging.info("Handoff mode (%s): sem resposta automática para %s", status, conversation_id)
+                logger.info("Handoff mode (%s): sem resposta automática para %s", status, conversation_id)
                 return
 
         was_resolved = status == "resolved"
 
         reset_cx_params = {}
         if was_resolved:
-            logging.info("Reabrindo bot após resolved para %s", conversation_id)
+            logger.info("Reabrindo bot após resolved para %s", conversation_id)
             repo.update_conversation(
                 conversation_id,
                 status="bot",
@@ -591,7 +879,7 @@ def process_message_async(
             and media_url
             and is_audio_media_type(media_type)
         ):
-            logging.info(
+            logger.info(
                 "Audio recebido para %s (msg=%s type=%s). Iniciando transcricao.",
                 conversation_id,
                 transcription_message_id,
@@ -625,7 +913,7 @@ def process_message_async(
                             transcription_source="google-stt",
                         )
                     except Exception as exc:
-                        logging.warning(
+                        logger.warning(
                             "Falha ao salvar transcricao no Firestore (conv=%s msg=%s): %s",
                             conversation_id,
                             transcription_message_id,
@@ -635,7 +923,7 @@ def process_message_async(
                 try:
                     repo.update_conversation(conversation_id, last_message_text=body)
                 except Exception:
-                    logging.warning("Falha ao atualizar last_message_text com transcricao", exc_info=True)
+                    logger.warning("Falha ao atualizar last_message_text com transcricao", exc_info=True)
             else:
                 log_event(
                     "audio_transcription_empty",
@@ -660,43 +948,45 @@ def process_message_async(
 
             params_dict = cx_all_params_dict(resp)
             if params_dict:
-                logging.info(
+                logger.info(
                     "Salvando session_parameters para %s: %s",
                     conversation_id,
                     list(params_dict.keys()),
                 )
-                repo.update_conversation(conversation_id, session_parameters=params_dict)
+                conv_updates["session_parameters"] = params_dict
 
         except Exception:
-            logging.error("DetectIntent falhou", exc_info=True)
+            logger.error("DetectIntent falhou", exc_info=True)
             reply_text = FALLBACK_STABILITY_TEXT
             if repo.message_exists(conversation_id, out_msg_id):
-                logging.info("Fallback do bot ja registrado para inbound_id=%s (skip send)", inbound_id)
+                logger.info("Fallback do bot ja registrado para inbound_id=%s (skip send)", inbound_id)
+                _flush_conv_updates(repo, conversation_id, conv_updates)
                 return
 
             fallback_success = send_whatsapp_text(frm, reply_text, settings=settings, http_session=http_session)
             if fallback_success:
-                created_out = repo.add_message_if_new(conversation_id, out_msg_id, "out", "bot", reply_text)
+                created_out = _commit_reply(repo, conversation_id, out_msg_id, reply_text, conv_updates)
                 if not created_out:
-                    logging.warning(
+                    logger.warning(
                         "Fallback enviado, mas mensagem ja existia no Firestore para out_msg_id=%s",
                         out_msg_id,
                     )
             else:
-                logging.error(
+                logger.error(
                     "Falha ao enviar fallback para %s out_msg_id=%s inbound_id=%s",
                     conversation_id,
                     out_msg_id,
                     inbound_id,
                 )
+                _flush_conv_updates(repo, conversation_id, conv_updates)
             return
 
         allow_handoff_param = status == "bot" and bool(settings.get("DF_HANDOFF_PARAM"))
-        handoff_requested = _handoff_from_cx(resp, texts, allow_param=allow_handoff_param, settings=settings)
+        handoff_requested = _handoff_from_cx(params_dict, texts, allow_param=allow_handoff_param, settings=settings)
 
         bot_reply_text = _join_bot_texts(texts)
         if not bot_reply_text:
-            logging.warning(
+            logger.warning(
                 "CX retornou sem texto para %s (handoff_requested=%s texts_count=%d).",
                 conversation_id,
                 handoff_requested,
@@ -705,7 +995,7 @@ def process_message_async(
 
         if handoff_requested:
             if settings.get("FEATURE_DISABLE_HANDOFF"):
-                logging.info("CX pediu handoff, mas está desabilitado: %s", conversation_id)
+                logger.info("CX pediu handoff, mas está desabilitado: %s", conversation_id)
                 log_event("handoff_disabled", conversation_id=conversation_id)
                 reply_text = (
                     settings.get("HANDOFF_DISABLED_TEXT")
@@ -714,16 +1004,19 @@ def process_message_async(
                     or FALLBACK_EMPTY_REPLY_TEXT
                 )
             else:
-                logging.info("CX pediu handoff: %s -> status=pending_handoff", conversation_id)
+                logger.info("CX pediu handoff: %s -> status=pending_handoff", conversation_id)
                 log_event("handoff_pending", conversation_id=conversation_id)
-                repo.update_conversation(
-                    conversation_id,
+                # Status gravado antes do envio, aproveitando o mesmo write para
+                # o que ja estava pendente.
+                conv_updates.update(
                     status="pending_handoff",
                     handoff_active=False,
                     assignee=None,
                     assignee_name=None,
                     pending_since=firestore.SERVER_TIMESTAMP,
                 )
+                repo.update_conversation(conversation_id, **conv_updates)
+                conv_updates = {}
                 reply_text = (
                     bot_reply_text
                     or settings.get("HANDOFF_ACK_TEXT")
@@ -733,31 +1026,33 @@ def process_message_async(
             reply_text = bot_reply_text or FALLBACK_EMPTY_REPLY_TEXT
 
         if repo.message_exists(conversation_id, out_msg_id):
-            logging.info("Resposta do bot ja registrada para inbound_id=%s (skip send)", inbound_id)
+            logger.info("Resposta do bot ja registrada para inbound_id=%s (skip send)", inbound_id)
+            _flush_conv_updates(repo, conversation_id, conv_updates)
             return
 
         success = send_whatsapp_text(frm, reply_text, settings=settings, http_session=http_session)
 
         if success:
-            created_out = repo.add_message_if_new(conversation_id, out_msg_id, "out", "bot", reply_text)
+            created_out = _commit_reply(repo, conversation_id, out_msg_id, reply_text, conv_updates)
             if not created_out:
-                logging.warning(
+                logger.warning(
                     "Resposta enviada, mas mensagem ja existia no Firestore para out_msg_id=%s",
                     out_msg_id,
                 )
-            logging.info(
+            logger.info(
                 "Resposta enviada com sucesso para %s out_msg_id=%s inbound_id=%s",
                 conversation_id,
                 out_msg_id,
                 inbound_id,
             )
         else:
-            logging.error(
+            logger.error(
                 "Falha ao enviar resposta para %s out_msg_id=%s inbound_id=%s",
                 conversation_id,
                 out_msg_id,
                 inbound_id,
             )
+            _flush_conv_updates(repo, conversation_id, conv_updates)
 
     except Exception as exc:
-        logging.error(f"Erro no processamento async: {exc}", exc_info=True)
+        logger.error("Erro no processamento async: %s", exc, exc_info=True)